@@ -1,13 +1,138 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional, Tuple
+import asyncio
 import sqlite3
 import logging
+import queue
+import threading
+import time
+import faiss
+import numpy as np
 
 # Import all helper functions and constants from main.py
 import main  
 
-app = FastAPI(title="Incident Solution API")
+
+# ---- DB Connection (one WAL-mode connection shared by all requests) ---- #
+_conn: Optional[sqlite3.Connection] = None
+_conn_lock = threading.Lock()
+
+
+def get_db() -> sqlite3.Connection:
+    """FastAPI dependency returning the shared connection, opened on first use."""
+    global _conn
+    with _conn_lock:
+        if _conn is None:
+            main.init_db()
+            _conn = main.connect_db(check_same_thread=False)
+            _start_writer()
+        return _conn
+
+
+def close_db():
+    global _conn
+    _stop_writer()
+    with _conn_lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+
+# ---- Background Writer ---- #
+# Incidents and solution cache rows are committed in batches by a daemon thread
+WRITE_BATCH_INTERVAL = 0.1
+WRITE_BATCH_SIZE = 500
+WRITE_RETRY_DELAY = 0.5      # first wait after "database is locked"; doubled per retry
+WRITE_RETRY_MAX_DELAY = 10.0
+
+_write_q: "queue.Queue[Optional[tuple]]" = queue.Queue()
+_writer: Optional[threading.Thread] = None
+
+
+def _is_busy(error: sqlite3.Error) -> bool:
+    message = str(error)
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+
+def _flush_writes(conn: sqlite3.Connection, batch: list):
+    cache_rows = main.take_solution_cache_rows()
+    delay = WRITE_RETRY_DELAY
+    while True:
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            if batch:
+                conn.executemany("""
+                    INSERT INTO incidents 
+                    (incident_number, customer_name, organization, department, description, detailed_description, reported_date, solution, priority, embedding)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, batch)
+            if cache_rows:
+                conn.executemany(main.SOLUTION_CACHE_INSERT, cache_rows)
+            conn.commit()
+            return
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.rollback()
+            if not _is_busy(e):
+                logging.error(f"Failed to write {len(batch)} incident(s): {e}")
+                return
+            # Another writer (e.g. process_excel) holds the lock: keep the rows and retry
+            logging.warning(f"Database busy writing {len(batch)} incident(s), retrying in {delay}s: {e}")
+            time.sleep(delay)
+            delay = min(delay * 2, WRITE_RETRY_MAX_DELAY)
+
+
+def _writer_loop():
+    conn = main.connect_db()
+    stop = False
+    while not stop:
+        item = _write_q.get()
+        batch = []
+        deadline = time.monotonic() + WRITE_BATCH_INTERVAL
+        while True:
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+            remaining = deadline - time.monotonic()
+            if len(batch) >= WRITE_BATCH_SIZE or remaining <= 0:
+                break
+            try:
+                item = _write_q.get(timeout=remaining)
+            except queue.Empty:
+                break
+        if batch or stop:  # the final pass also drains leftover solution cache rows
+            _flush_writes(conn, batch)
+    conn.close()
+
+
+def _start_writer():
+    global _writer
+    if _writer is None or not _writer.is_alive():
+        _writer = threading.Thread(target=_writer_loop, name="incident-writer", daemon=True)
+        _writer.start()
+
+
+def _stop_writer():
+    global _writer
+    if _writer is not None and _writer.is_alive():
+        _write_q.put(None)
+        _writer.join()
+    _writer = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    save_vector_index()
+    close_db()
+    if main.get_client.cache_info().currsize:  # only close a client that was created
+        await main.get_client().close()
+
+
+app = FastAPI(title="Incident Solution API", lifespan=lifespan)
 
 # ---- Pydantic Model ---- #
 class IncidentRequest(BaseModel):
@@ -20,26 +145,63 @@ class IncidentRequest(BaseModel):
     reported_date: str
 
 
-# ---- DB Helpers (thin wrappers using main.DB_FILE) ---- #
-def load_existing_incidents():
-    conn = sqlite3.connect(main.DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT Description, Detailed_Description, Solution, Priority FROM incidents ORDER BY Priority DESC"
-    )
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+# ---- Incident Cache ---- #
+# Append-only parallel lists in id order; FAISS id i is row i
+INDEX_SAVE_EVERY = 100  # persist the index after this many additions (and on shutdown)
+
+_texts: List[str] = []
+_solutions: List[str] = []
+_priorities: List[int] = []
+_index: Optional[faiss.Index] = None
+_unsaved_additions = 0
+_incidents_loaded = False
+_incidents_lock = threading.RLock()
 
 
-def save_incident(incident: IncidentRequest, solution: str, priority: int):
-    conn = sqlite3.connect(main.DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO incidents 
-        (incident_number, customer_name, organization, department, description, detailed_description, reported_date, solution, priority)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+def load_existing_incidents(conn: sqlite3.Connection) -> Tuple[List[str], List[str], List[int], faiss.Index]:
+    global _texts, _solutions, _priorities, _index, _incidents_loaded
+    with _incidents_lock:
+        if not _incidents_loaded:
+            with _conn_lock:
+                rows = conn.execute(main.INCIDENT_LOAD_QUERY).fetchall()
+            _texts, _solutions, _priorities = main.incident_columns(rows)
+            checksum = main.texts_checksum(_texts)
+            _index = main.load_index(len(rows), checksum)
+            if _index is None:
+                _index = main.build_index(main.build_embedding_matrix(rows))
+                main.save_index(_index, checksum)
+            _incidents_loaded = True
+        return _texts, _solutions, _priorities, _index
+
+
+def _cache_incident(text: str, solution: str, priority: int, embedding: np.ndarray):
+    global _unsaved_additions
+    with _incidents_lock:
+        if not _incidents_loaded:
+            return
+        _texts.append(text)
+        _solutions.append(solution)
+        _priorities.append(priority)
+        with main.index_lock:
+            _index.add(embedding[None, :].astype(np.float32))
+        _unsaved_additions += 1
+        if _unsaved_additions >= INDEX_SAVE_EVERY:
+            save_vector_index()
+
+
+def save_vector_index():
+    global _unsaved_additions
+    with _incidents_lock:
+        if _index is not None and _unsaved_additions:
+            main.save_index(_index, main.texts_checksum(_texts))
+            _unsaved_additions = 0
+
+
+# ---- DB Helpers (thin wrappers using main.DB_FILE) ---- #
+def save_incident(incident: IncidentRequest, solution: str, priority: int, embedding: np.ndarray):
+    """Queue the incident for the background writer and add it to the in-memory cache."""
+    blob = main.embedding_to_blob(embedding)
+    _write_q.put((
         incident.incident_num,
         incident.customer_name,
         incident.organization,
@@ -48,38 +210,41 @@ def save_incident(incident: IncidentRequest, solution: str, priority: int):
         incident.detailed_description,
         incident.reported_date,
         solution,
-        priority
+        priority,
+        blob
     ))
-    conn.commit()
-    conn.close()
+    _cache_incident(main.incident_text(incident.description, incident.detailed_description), solution, priority, embedding)
 
 
 # ---- FastAPI Endpoint ---- #
 @app.post("/get_solution")
-def get_solution(incident: IncidentRequest):
-    existing_incidents = load_existing_incidents()
-    db_empty = len(existing_incidents) == 0
+async def get_solution(incident: IncidentRequest, conn: sqlite3.Connection = Depends(get_db)):
+    # Blocking work runs in worker threads so requests are not serialised
+    texts, solutions, priorities, index = await asyncio.to_thread(load_existing_incidents, conn)
+    embedding = await asyncio.to_thread(main.embed_incident, incident.description, incident.detailed_description)
+    db_empty = len(texts) == 0
 
     # Case 1: Empty DB → always generate
     if db_empty:
-        solution = main.generate_solution(incident.description, incident.detailed_description)
+        solution = await main.generate_solution(incident.description, incident.detailed_description, embedding)
         logging.info("Generated new solution (DB empty).")
     else:
         # Case 2: Try reuse, else generate
-        existing_solution = main.find_solution(
-            incident.description, incident.detailed_description, existing_incidents
+        existing_solution = await main.find_solution(
+            incident.description, incident.detailed_description, texts, solutions, priorities,
+            index=index, new_embedding=embedding
         )
         if existing_solution:
             solution = existing_solution
             logging.info("Reused existing solution.")
         else:
-            solution = main.generate_solution(incident.description, incident.detailed_description)
+            solution = await main.generate_solution(incident.description, incident.detailed_description, embedding)
             logging.info("Generated new solution.")
 
     # Calculate priority
     priority = main.calculate_priority(incident.description, incident.detailed_description)
 
-    # Save to DB
-    save_incident(incident, solution, priority)
+    # Save to DB (in a worker thread: every INDEX_SAVE_EVERY additions this writes the index to disk)
+    await asyncio.to_thread(save_incident, incident, solution, priority, embedding)
 
     return {"priority": priority, "solution": solution}
@@ -1,19 +1,73 @@
 import sqlite3
+import asyncio
+import hashlib
+import json
+import httpx
 import openai
 import os
+import threading
 import time
 import logging
+import tiktoken
+import faiss
+import numpy as np
 import pandas as pd
-from typing import Optional, List, Tuple
+from collections import OrderedDict, deque
+from functools import lru_cache
+from typing import Dict, Optional, List, Tuple
 from dotenv import load_dotenv
+from rapidfuzz import fuzz, process, utils
+from sentence_transformers import SentenceTransformer
 
 # ---- Setup ---- #
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 MODEL = "gpt-4o"
 
+# One shared HTTP/2 client; the pool is sized well above MAX_CONCURRENT_LLM_CALLS
+HTTP_MAX_CONNECTIONS = 200
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 100
+HTTP_TIMEOUT = httpx.Timeout(30.0, read=90.0)  # generations can take longer than 30s to return
+
+@lru_cache(maxsize=1)
+def get_client() -> openai.AsyncOpenAI:
+    """Create the shared client on first use, so importing this module needs no API key."""
+    return openai.AsyncOpenAI(
+        api_key=openai.api_key,
+        max_retries=0,  # retries are handled by chat_completion
+        http_client=openai.DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS
+            ),
+            timeout=HTTP_TIMEOUT,
+            http2=True,
+        ),
+    )
+
 MAX_RETRIES = 3
-SLEEP_BETWEEN_RETRIES = 2
+BACKOFF_BASE = 1  # seconds; doubled after each transient failure
+MAX_CONCURRENT_LLM_CALLS = 20
+
+# Account limits for MODEL; calls are paced to stay under them instead of hitting 429s
+REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_RPM", "500"))
+TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TPM", "30000"))
+COMPLETION_TOKEN_ESTIMATE = 300  # reserved per call on top of the prompt tokens
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+EMBEDDING_DIM = 384
+EMBEDDING_SCALE = 127  # embeddings are stored as int8 codes round(x * 127)
+SEMANTIC_MATCH_THRESHOLD = 0.92  # above this cosine similarity a stored solution is reused without the LLM
+TOP_K_CANDIDATES = 3             # shortlisted incidents confirmed by the LLM
+
+HNSW_M = 32               # graph neighbours per node
+HNSW_EF_SEARCH = 64       # candidate list size while searching (recall vs speed)
+
+FUZZY_MATCH_CUTOFF = 85    # token_set_ratio and token_sort_ratio both at or above this reuse a stored solution directly
+FUZZY_REVIEW_CUTOFF = 70   # other token_set_ratio matches at or above this go to the LLM
+USE_LLM_FALLBACK = True    # set to False to decide on fuzzy/embedding scores alone
+
+SOLUTION_CACHE_SIZE = 1024        # exact-match entries kept in memory
+SOLUTION_CACHE_THRESHOLD = 0.95   # cosine similarity for reusing a previously generated solution
 
 logging.basicConfig(
     level=logging.INFO,
@@ -23,8 +77,19 @@ logging.basicConfig(
 )
 
 DB_FILE = "incidents.db"
+INDEX_FILE = "incidents.faiss"
 
 # ---- DB Setup ---- #
+def connect_db(check_same_thread: bool = True) -> sqlite3.Connection:
+    """Open DB_FILE in autocommit mode with WAL journaling and synchronous=NORMAL.
+
+    Callers group writes with an explicit BEGIN IMMEDIATE ... COMMIT.
+    """
+    conn = sqlite3.connect(DB_FILE, check_same_thread=check_same_thread, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
 def init_db():
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
@@ -39,150 +104,653 @@ def init_db():
             Detailed_Description TEXT,
             Reported_Date TEXT,
             Solution TEXT,
-            Priority INTEGER
+            Priority INTEGER,
+            Embedding BLOB
+        )
+    """)
+    # Databases created before embeddings were introduced lack the column
+    cursor.execute("PRAGMA table_info(incidents)")
+    if "Embedding" not in {col[1] for col in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE incidents ADD COLUMN Embedding BLOB")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS solutions_cache (
+            Prompt_Hash TEXT PRIMARY KEY,
+            Embedding BLOB,
+            Solution TEXT
         )
     """)
     conn.commit()
     conn.close()
 
+# ---- Embeddings ---- #
+@lru_cache(maxsize=1)
+def get_embedding_model() -> SentenceTransformer:
+    """Load the sentence-transformer once and share it for the process lifetime."""
+    return SentenceTransformer(EMBEDDING_MODEL)
+
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """Encode texts into L2-normalised float32 vectors, one row per text."""
+    embeddings = get_embedding_model().encode(
+        texts, batch_size=64, normalize_embeddings=True, convert_to_numpy=True
+    )
+    return embeddings.astype(np.float32)
+
+def incident_text(description: str, detailed: str) -> str:
+    return f"{description} {detailed}"
+
+def embed_incident(description: str, detailed: str) -> np.ndarray:
+    return embed_texts([incident_text(description, detailed)])[0]
+
+def quantize_embedding(embedding: np.ndarray) -> np.ndarray:
+    """int8 codes for a normalised embedding (components lie in [-1, 1])."""
+    return np.clip(np.round(embedding * EMBEDDING_SCALE), -EMBEDDING_SCALE, EMBEDDING_SCALE).astype(np.int8)
+
+def embedding_to_blob(embedding: np.ndarray) -> bytes:
+    return quantize_embedding(embedding).tobytes()
+
+def blob_to_embedding(blob: bytes) -> np.ndarray:
+    if len(blob) == EMBEDDING_DIM * 4:  # float32 rows stored before embeddings were quantised
+        return np.frombuffer(blob, dtype=np.float32)
+    return np.frombuffer(blob, dtype=np.int8).astype(np.float32) / EMBEDDING_SCALE
+
+# Columns read back for matching, in id order so row positions are FAISS ids
+INCIDENT_LOAD_QUERY = "SELECT Description, Detailed_Description, Solution, Priority, Embedding FROM incidents ORDER BY id"
+
+def incident_columns(rows: List[Tuple]) -> Tuple[List[str], List[str], List[int]]:
+    """Split INCIDENT_LOAD_QUERY rows into parallel incident_text, solution and
+    priority lists, so the texts are built once, not per lookup."""
+    texts = [incident_text(row[0], row[1]) for row in rows]
+    solutions = [row[2] for row in rows]
+    priorities = [row[3] for row in rows]
+    return texts, solutions, priorities
+
+def build_embedding_matrix(existing_incidents: List[Tuple]) -> np.ndarray:
+    """Stack stored embeddings into an (N, EMBEDDING_DIM) matrix, encoding rows saved without one."""
+    matrix = np.empty((len(existing_incidents), EMBEDDING_DIM), dtype=np.float32)
+    missing = []
+    for i, (_, _, _, _, blob) in enumerate(existing_incidents):
+        if blob:
+            matrix[i] = blob_to_embedding(blob)
+        else:
+            missing.append(i)
+    if missing:
+        texts = [incident_text(existing_incidents[i][0], existing_incidents[i][1]) for i in missing]
+        matrix[missing] = embed_texts(texts)
+    return matrix
+
+# ---- Vector Index ---- #
+# FAISS allows concurrent searches but not a search during an add
+index_lock = threading.Lock()
+
+def build_index(embeddings: np.ndarray) -> faiss.Index:
+    """Inner-product HNSW over 8-bit quantised embeddings; ids are row positions in insertion order."""
+    index = faiss.IndexHNSWSQ(EMBEDDING_DIM, faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    # Normalised embeddings lie in [-1, 1], so pinning that range makes training data-free
+    bounds = np.vstack([-np.ones(EMBEDDING_DIM), np.ones(EMBEDDING_DIM)]).astype(np.float32)
+    index.train(bounds)
+    index.hnsw.efSearch = HNSW_EF_SEARCH
+    if len(embeddings):
+        index.add(np.ascontiguousarray(embeddings, dtype=np.float32))
+    return index
+
+def texts_checksum(texts: List[str]) -> str:
+    """SHA-256 over the incident texts in id order, saved next to the index they were embedded into."""
+    digest = hashlib.sha256()
+    for text in texts:
+        digest.update(text.encode("utf-8") + b"\0")
+    return digest.hexdigest()
+
+def save_index(index: faiss.Index, checksum: str, path: str = INDEX_FILE):
+    tmp_path = path + ".tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+    # Written after the index: a crash in between leaves a mismatch, which only forces a rebuild
+    with open(tmp_path, "w") as f:
+        f.write(checksum)
+    os.replace(tmp_path, path + ".sha256")
+
+def load_index(expected_size: int, expected_checksum: str, path: str = INDEX_FILE) -> Optional[faiss.Index]:
+    """Read a persisted index, or None if it is missing or its size or texts_checksum differ from the DB."""
+    if not os.path.exists(path):
+        return None
+    try:
+        index = faiss.read_index(path)
+        with open(path + ".sha256") as f:
+            checksum = f.read().strip()
+    except (RuntimeError, OSError) as e:
+        logging.warning(f"Could not read vector index {path}: {e}")
+        return None
+    if index.ntotal != expected_size or checksum != expected_checksum:
+        logging.info(f"Vector index {path} ({index.ntotal} entries) does not match the {expected_size} stored incidents; rebuilding")
+        return None
+    # downcast_index returns a non-owning view, so keep returning the owning object
+    hnsw = faiss.downcast_index(index)
+    if not isinstance(hnsw, faiss.IndexHNSWSQ):  # float32 index from before quantisation
+        logging.info(f"Vector index {path} is not quantised; rebuilding")
+        return None
+    hnsw.hnsw.efSearch = HNSW_EF_SEARCH
+    return index
+
 # ---- Priority Calculation ---- #
+PRIORITY_KEYWORDS = {
+    5: ["critical", "outage", "failure", "breach", "security"],
+    4: ["error", "crash", "slow", "timeout"],
+    3: ["bug", "issue", "problem"],
+    2: ["request", "access", "minor"],
+}
+_TIERS = sorted(PRIORITY_KEYWORDS.items(), reverse=True)  # highest tier first
+
 def calculate_priority(description: str, detailed_description: str) -> int:
-    desc = (description + " " + detailed_description).lower()
-    if any(word in desc for word in ["critical", "outage", "failure", "breach", "security"]):
-        return 5
-    elif any(word in desc for word in ["error", "crash", "slow", "timeout"]):
-        return 4
-    elif any(word in desc for word in ["bug", "issue", "problem"]):
-        return 3
-    elif any(word in desc for word in ["request", "access", "minor"]):
-        return 2
+    text = f"{description} {detailed_description}".lower()  # one buffer, lowercased once
+    for tier, words in _TIERS:
+        if any(word in text for word in words):
+            return tier
     return 1
 
+# ---- Rate Limiting ---- #
+class RateLimiter:
+    """Rolling-window request and token budget, as in OpenAI's api_request_parallel_processor.
+
+    Both capacities refill continuously at their per-minute rate; acquire() waits
+    until there is room for the call instead of letting the API answer 429.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.max_requests = requests_per_minute
+        self.max_tokens = tokens_per_minute
+        self.available_request_capacity = requests_per_minute
+        self.available_token_capacity = tokens_per_minute
+        self.last_update = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.available_request_capacity = min(
+            self.max_requests, self.available_request_capacity + self.max_requests * elapsed / 60
+        )
+        self.available_token_capacity = min(
+            self.max_tokens, self.available_token_capacity + self.max_tokens * elapsed / 60
+        )
+        self.last_update = now
+
+    async def acquire(self, tokens: int):
+        tokens = min(tokens, self.max_tokens)
+        while True:
+            self._refill()
+            if self.available_request_capacity >= 1 and self.available_token_capacity >= tokens:
+                self.available_request_capacity -= 1
+                self.available_token_capacity -= tokens
+                return
+            # Sleep just until the scarcer budget has refilled enough
+            wait = max(
+                (1 - self.available_request_capacity) * 60 / self.max_requests,
+                (tokens - self.available_token_capacity) * 60 / self.max_tokens,
+            )
+            await asyncio.sleep(max(wait, 0.01))
+
+rate_limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+# Transient failures worth retrying; anything else (bad request, auth, ...) fails at once
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+@lru_cache(maxsize=1)
+def get_encoding() -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(MODEL)
+
+def estimate_tokens(request: dict) -> int:
+    """Prompt tokens of a chat-completion request plus the reserved completion budget."""
+    encoding = get_encoding()
+    prompt_tokens = sum(len(encoding.encode(message["content"])) + 4 for message in request["messages"]) + 2
+    return prompt_tokens + COMPLETION_TOKEN_ESTIMATE
+
+async def chat_completion(request: dict) -> str:
+    """Send one chat completion paced by the rate limiter and return the message content.
+
+    Transient errors are retried with exponential backoff; the last one is re-raised.
+    """
+    # The first call loads (possibly downloads) the BPE file, so keep it off the event loop
+    tokens = await asyncio.to_thread(estimate_tokens, request)
+    for attempt in range(MAX_RETRIES):
+        await rate_limiter.acquire(tokens)
+        try:
+            response = await get_client().chat.completions.create(**request)
+            return response.choices[0].message.content
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            delay = BACKOFF_BASE * 2 ** attempt
+            logging.warning(f"LLM call failed (attempt {attempt+1}), retrying in {delay}s: {e}")
+            await asyncio.sleep(delay)
+
 # ---- Similarity Check ---- #
 SIMILARITY_PROMPT = """
-You are an assistant that checks whether two IT incidents describe the SAME issue.
+You are an assistant that checks whether IT incidents describe the SAME issue.
 
-Incident A:
-{incident_a}
+New incident:
+{new_incident}
 
-Incident B:
-{incident_b}
+Candidate incidents:
+{candidates}
 
-Respond with ONLY one word:
-- "YES" if they are essentially the same incident
-- "NO" if they are different
+For each candidate, in order, answer "YES" if it is essentially the same incident
+as the new one and "NO" if it is different.
+Respond with ONLY a JSON object of the form {{"matches": ["YES", "NO", ...]}}
+containing exactly {count} answers.
 """
 
-def check_incident_similarity(incident_a: str, incident_b: str) -> bool:
-    prompt = SIMILARITY_PROMPT.format(incident_a=incident_a, incident_b=incident_b)
-    for attempt in range(MAX_RETRIES):
-        try:
-            response = openai.chat.completions.create(
-                model=MODEL,
-                messages=[
-                    {"role": "system", "content": "You are an assistant for comparing IT incidents."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.0,
-            )
-            result = response.choices[0].message.content.strip().upper()
-            return result == "YES"
-        except Exception as e:
-            logging.warning(f"Similarity check failed (attempt {attempt+1}): {e}")
-            time.sleep(SLEEP_BETWEEN_RETRIES)
-    logging.error("Failed to check similarity after retries.")
-    return False
+def similarity_request(new_text: str, candidates: List[str]) -> dict:
+    """Chat-completion arguments comparing one incident against numbered candidates."""
+    numbered = "\n".join(f"{i}. {candidate}" for i, candidate in enumerate(candidates, start=1))
+    prompt = SIMILARITY_PROMPT.format(new_incident=new_text, candidates=numbered, count=len(candidates))
+    return {
+        "model": MODEL,
+        "messages": [
+            {"role": "system", "content": "You are an assistant for comparing IT incidents."},
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 0.0,
+        "response_format": {"type": "json_object"},
+    }
+
+def parse_similarity_response(content: str, count: int) -> List[bool]:
+    matches = json.loads(content)["matches"]
+    if len(matches) != count:
+        raise ValueError(f"expected {count} answers, got {len(matches)}")
+    return [str(answer).strip().upper() == "YES" for answer in matches]
+
+async def check_incident_similarity_batch(new_text: str, candidates: List[str]) -> List[bool]:
+    """Compare one incident against several candidates in a single LLM request."""
+    if not candidates:
+        return []
+    try:
+        content = await chat_completion(similarity_request(new_text, candidates))
+        return parse_similarity_response(content, len(candidates))
+    except Exception as e:
+        logging.error(f"Similarity check failed: {e}")
+        return [False] * len(candidates)
 
 # ---- Solution Retrieval ---- #
-def find_solution(new_description: str, new_detailed: str, existing_incidents: List[Tuple]) -> Optional[str]:
+def shortlist_incident(
+    new_text: str,
+    texts: List[str],
+    index: faiss.Index,
+    new_embedding: np.ndarray,
+) -> Tuple[Optional[int], List[int]]:
+    """Score the known incidents locally, without any LLM call.
+
+    Returns (match, shortlist): an index accepted outright by fuzzy or embedding
+    score, or else the candidates for the LLM to confirm.
+    """
+    if not texts:
+        return None, []
+
+    fuzzy_hits = process.extract(
+        new_text, texts, scorer=fuzz.token_set_ratio, processor=utils.default_process,
+        score_cutoff=FUZZY_REVIEW_CUTOFF, limit=TOP_K_CANDIDATES,
+    )
+    # token_set_ratio is 100 for word subsets, so a direct reuse also needs token_sort_ratio
+    strict_hits = [
+        (fuzz.token_sort_ratio(new_text, texts[idx], processor=utils.default_process), idx)
+        for _, score, idx in fuzzy_hits if score >= FUZZY_MATCH_CUTOFF
+    ]
+    if strict_hits:
+        score, best = max(strict_hits, key=lambda hit: hit[0])
+        if score >= FUZZY_MATCH_CUTOFF:
+            logging.info(f"Fuzzy match ({score:.1f})")
+            return best, []
+
+    with index_lock:
+        sims, ids = index.search(new_embedding[None, :].astype(np.float32), TOP_K_CANDIDATES)
+    # -1 pads short results; ids past len(texts) were added after this snapshot was taken
+    found = (ids[0] >= 0) & (ids[0] < len(texts))
+    sims, top = sims[0][found], ids[0][found]
+
+    if len(top) and sims[0] > SEMANTIC_MATCH_THRESHOLD:
+        logging.info(f"Semantic match ({sims[0]:.3f})")
+        return int(top[0]), []
+
+    if not USE_LLM_FALLBACK:
+        return None, []
+    return None, list(dict.fromkeys([idx for _, _, idx in fuzzy_hits] + top.tolist()))
+
+def best_confirmed(shortlist: List[int], results: List[bool], priorities: List[int]) -> Optional[int]:
+    """The highest-priority candidate the LLM confirmed; shortlist order breaks ties."""
+    confirmed = [i for i, is_similar in zip(shortlist, results) if is_similar]
+    return max(confirmed, key=lambda i: priorities[i] or 0, default=None)
+
+async def match_incident(
+    new_text: str,
+    texts: List[str],
+    priorities: List[int],
+    index: faiss.Index,
+    new_embedding: np.ndarray,
+) -> Optional[int]:
+    """Return the index of the known incident that describes the same issue, if any."""
+    # RapidFuzz and the index search are CPU-bound; keep them off the event loop
+    match, shortlist = await asyncio.to_thread(shortlist_incident, new_text, texts, index, new_embedding)
+    if match is not None or not shortlist:
+        return match
+    results = await check_incident_similarity_batch(new_text, [texts[i] for i in shortlist])
+    return best_confirmed(shortlist, results, priorities)
+
+async def find_solution(
+    new_description: str,
+    new_detailed: str,
+    texts: List[str],
+    solutions: List[str],
+    priorities: List[int],
+    index: Optional[faiss.Index] = None,
+    new_embedding: Optional[np.ndarray] = None,
+) -> Optional[str]:
     """Check for existing solutions in already loaded incidents (memory lookup)."""
-    new_text = f"{new_description} {new_detailed}"
-    for desc, det_desc, sol, priority in existing_incidents:
-        if check_incident_similarity(new_text, f"{desc} {det_desc}"):
-            logging.info(f"Similar incident found with priority {priority}: {desc}")
-            return sol
+    if not texts:
+        return None
+    new_text = incident_text(new_description, new_detailed)
+    if new_embedding is None:
+        new_embedding = (await asyncio.to_thread(embed_texts, [new_text]))[0]
+    if index is None:
+        index = build_index(await asyncio.to_thread(embed_texts, texts))
+
+    match = await match_incident(new_text, texts, priorities, index, new_embedding)
+    if match is None:
+        return None
+    logging.info(f"Similar incident found: {texts[match]}")
+    return solutions[match]
+
+# ---- Solution Cache ---- #
+# Exact LRU by prompt hash plus a semantic ring buffer; new rows wait for flush_solution_cache
+SOLUTION_CACHE_INSERT = "INSERT OR REPLACE INTO solutions_cache (Prompt_Hash, Embedding, Solution) VALUES (?, ?, ?)"
+
+_exact_cache: "OrderedDict[str, str]" = OrderedDict()
+_semantic_embeddings = np.zeros((SOLUTION_CACHE_SIZE, EMBEDDING_DIM), dtype=np.float32)
+_semantic_solutions: List[Optional[str]] = [None] * SOLUTION_CACHE_SIZE
+_semantic_count = 0  # filled slots
+_semantic_next = 0   # slot overwritten by the next insert (the oldest once full)
+_pending_cache_rows: "deque[tuple]" = deque()
+_solution_cache_loaded = False
+_solution_cache_lock = threading.Lock()
+
+def _add_semantic(embedding: np.ndarray, solution: str):
+    global _semantic_count, _semantic_next
+    _semantic_embeddings[_semantic_next] = embedding
+    _semantic_solutions[_semantic_next] = solution
+    _semantic_next = (_semantic_next + 1) % SOLUTION_CACHE_SIZE
+    _semantic_count = min(_semantic_count + 1, SOLUTION_CACHE_SIZE)
+
+def _load_solution_cache():
+    global _solution_cache_loaded
+    with _solution_cache_lock:
+        if _solution_cache_loaded:  # concurrent first requests may both ask for the load
+            return
+        conn = connect_db()
+        rows = conn.execute(
+            "SELECT Prompt_Hash, Embedding, Solution FROM solutions_cache ORDER BY rowid DESC LIMIT ?",
+            (SOLUTION_CACHE_SIZE,)
+        ).fetchall()
+        conn.close()
+        for key, blob, sol in reversed(rows):  # oldest first, so the LRU order matches
+            _exact_cache[key] = sol
+            _add_semantic(blob_to_embedding(blob), sol)
+        _solution_cache_loaded = True
+
+def clear_solution_cache():
+    """Drop the in-memory layers; they are reloaded from the table on next use."""
+    global _semantic_count, _semantic_next, _solution_cache_loaded
+    _exact_cache.clear()
+    _semantic_count = _semantic_next = 0
+    _solution_cache_loaded = False
+
+def get_cached_solution(key: str, embedding: np.ndarray) -> Optional[str]:
+    if not _solution_cache_loaded:
+        _load_solution_cache()
+    if key in _exact_cache:
+        _exact_cache.move_to_end(key)
+        return _exact_cache[key]
+    if _semantic_count:
+        sims = _semantic_embeddings[:_semantic_count] @ embedding
+        best = int(np.argmax(sims))
+        if sims[best] > SOLUTION_CACHE_THRESHOLD:
+            logging.info(f"Solution cache semantic hit ({sims[best]:.3f})")
+            return _semantic_solutions[best]
     return None
 
+def cache_solution(key: str, embedding: np.ndarray, solution: str):
+    _exact_cache[key] = solution
+    _exact_cache.move_to_end(key)
+    if len(_exact_cache) > SOLUTION_CACHE_SIZE:
+        _exact_cache.popitem(last=False)
+    _add_semantic(embedding, solution)
+    _pending_cache_rows.append((key, embedding_to_blob(embedding), solution))
+
+def take_solution_cache_rows() -> List[tuple]:
+    """Remove and return the cache rows queued since the last call."""
+    rows = []
+    while _pending_cache_rows:
+        rows.append(_pending_cache_rows.popleft())
+    return rows
+
+def flush_solution_cache(conn: sqlite3.Connection) -> int:
+    """Write the cache rows queued since the last flush; returns how many were written."""
+    rows = take_solution_cache_rows()
+    if rows:
+        conn.executemany(SOLUTION_CACHE_INSERT, rows)
+    return len(rows)
+
 # ---- Get Solution from LLM ---- #
-def generate_solution(description: str, detailed: str) -> str:
-    prompt = f"""
+def solution_prompt(description: str, detailed: str) -> str:
+    return f"""
     Incident:
     {description}\n{detailed}
 
     Provide a concise IT support resolution (step-by-step if needed).
     """
-    for attempt in range(MAX_RETRIES):
+
+def solution_cache_key(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+def solution_request(prompt: str) -> dict:
+    """Chat-completion arguments for generating a resolution."""
+    return {
+        "model": MODEL,
+        "messages": [
+            {"role": "system", "content": "You are an IT support assistant that provides practical resolutions."},
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 0.3,
+    }
+
+async def generate_solution(description: str, detailed: str, embedding: Optional[np.ndarray] = None) -> str:
+    prompt = solution_prompt(description, detailed)
+    key = solution_cache_key(prompt)
+    if embedding is None:
+        embedding = await asyncio.to_thread(embed_incident, description, detailed)
+    if not _solution_cache_loaded:  # first use reads the table; do that off the event loop
+        await asyncio.to_thread(_load_solution_cache)
+    cached = get_cached_solution(key, embedding)
+    if cached is not None:
+        return cached
+
+    try:
+        solution = (await chat_completion(solution_request(prompt))).strip()
+    except Exception as e:
+        logging.error(f"Solution generation failed: {e}")
+        return "No solution could be generated."
+    cache_solution(key, embedding, solution)
+    return solution
+
+# ---- OpenAI Batch API (offline bulk jobs) ---- #
+BATCH_POLL_INTERVAL = 30  # seconds between status checks
+BATCH_COMPLETION_WINDOW = "24h"
+
+async def run_chat_batch(requests: Dict[str, dict]) -> Dict[str, str]:
+    """Run {custom_id: request} through the Batch API; returns content for the ones that succeeded."""
+    if not requests:
+        return {}
+    lines = [
+        json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body})
+        for custom_id, body in requests.items()
+    ]
+    client = get_client()
+    try:
+        batch_file = await client.files.create(file=("batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+        batch = await client.batches.create(
+            input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window=BATCH_COMPLETION_WINDOW
+        )
+        logging.info(f"Submitted batch {batch.id} with {len(requests)} request(s)")
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+            batch = await client.batches.retrieve(batch.id)
+        if batch.status != "completed" or not batch.output_file_id:
+            logging.error(f"Batch {batch.id} ended with status {batch.status}")
+            return {}
+        output = await client.files.content(batch.output_file_id)
+    except Exception as e:
+        logging.error(f"Batch run failed: {e}")
+        return {}
+
+    results = {}
+    for line in output.text.splitlines():
         try:
-            response = openai.chat.completions.create(
-                model=MODEL,
-                messages=[
-                    {"role": "system", "content": "You are an IT support assistant that provides practical resolutions."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.3,
-            )
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            logging.warning(f"Solution generation failed (attempt {attempt+1}): {e}")
-            time.sleep(SLEEP_BETWEEN_RETRIES)
-    return "No solution could be generated."
+            item = json.loads(line)
+            response = item.get("response") or {}
+            if response.get("status_code") == 200:
+                results[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        except Exception as e:  # one bad line must not discard the rest of the batch
+            logging.warning(f"Skipping unreadable line in batch {batch.id} output: {e}")
+    logging.info(f"Batch {batch.id} returned {len(results)}/{len(requests)} result(s)")
+    return results
 
 # ---- Process Excel ---- #
-def process_excel(file_path: str):
-    df = pd.read_excel(file_path, sheet_name="Incident Details with REQ and R")
+EXCEL_COLUMNS = [
+    "Incident Number", "Customer Name", "Organization", "Department",
+    "Description", "Detailed Decription", "Reported Date",
+]
 
-    conn = sqlite3.connect(DB_FILE)
+async def process_excel(file_path: str, use_batch_api: bool = False):
+    """Load incidents from the Excel export, reuse or generate solutions and store them."""
+    # pandas opens the workbook read-only with openpyxl; usecols skips the columns we never touch
+    df = pd.read_excel(
+        file_path, sheet_name="Incident Details with REQ and R", engine="openpyxl", usecols=EXCEL_COLUMNS
+    )
+
+    conn = connect_db()
     cursor = conn.cursor()
 
     # Load all existing incidents into memory once
-    cursor.execute("SELECT Description, Detailed_Description, Solution, Priority FROM incidents ORDER BY Priority DESC")
+    cursor.execute(INCIDENT_LOAD_QUERY)
     existing_incidents = cursor.fetchall()
-    db_empty = len(existing_incidents) == 0  # <-- check if DB is empty
-
-    new_records = []
 
     df = df.sample(n=20, random_state=42) ## You can change/comment it according to your data
     print(f"length is {len(df)}")
 
-    for idx, row in df.iterrows():
-        inc_no = row["Incident Number"]
-        cust = row["Customer Name"]
-        org = row["Organization"]
-        dept = row["Department"]
-        desc = str(row["Description"])
-        det_desc = str(row["Detailed Decription"])
-        rep_date = str(row["Reported Date"])
-
-        # Case 1: Empty DB → always generate from LLM
-        if db_empty:
-            solution = generate_solution(desc, det_desc)
-            logging.info(f"Generated new solution for Incident {inc_no} (DB empty)")
+    # Plain column lists; str() per date keeps the full "YYYY-MM-DD HH:MM:SS" form
+    inc_nos = df["Incident Number"].tolist()
+    customers = df["Customer Name"].tolist()
+    orgs = df["Organization"].tolist()
+    depts = df["Department"].tolist()
+    descs = df["Description"].astype(str).tolist()
+    det_descs = df["Detailed Decription"].astype(str).tolist()
+    rep_dates = [str(value) for value in df["Reported Date"].tolist()]
+
+    # Row i is matched against stored incidents plus rows 0..i-1
+    new_texts = [incident_text(desc, det_desc) for desc, det_desc in zip(descs, det_descs)]
+    new_embeddings = embed_texts(new_texts)
+    n_stored = len(existing_incidents)
+    stored_texts, stored_solutions, stored_priorities = incident_columns(existing_incidents)
+    all_texts = stored_texts + new_texts
+    priorities = [calculate_priority(desc, det_desc) for desc, det_desc in zip(descs, det_descs)]
+    all_priorities = stored_priorities + priorities
+    index = build_index(build_embedding_matrix(existing_incidents))
+
+    # Pass 1: local scoring only
+    matches: List[Optional[int]] = []
+    shortlists: Dict[int, List[int]] = {}  # row index -> candidates the LLM must confirm
+    for i in range(len(new_texts)):
+        known = n_stored + i
+        match, shortlist = shortlist_incident(new_texts[i], all_texts[:known], index, new_embeddings[i])
+        index.add(new_embeddings[i:i + 1])
+        matches.append(match)
+        if shortlist:
+            shortlists[i] = shortlist
+
+    # Pass 2: LLM review of the shortlists
+    review = {i: [all_texts[j] for j in shortlist] for i, shortlist in shortlists.items()}
+    if use_batch_api:
+        contents = await run_chat_batch({f"similarity-{i}": similarity_request(new_texts[i], cands) for i, cands in review.items()})
+        results = {}
+        for i, cands in review.items():
+            try:
+                results[i] = parse_similarity_response(contents[f"similarity-{i}"], len(cands))
+            except Exception as e:  # missing, refused (null content) or malformed answer
+                logging.warning(f"Batch similarity result unusable for row {i} ({e}); retrying live")
+                results[i] = await check_incident_similarity_batch(new_texts[i], cands)
+    else:
+        sem = asyncio.Semaphore(MAX_CONCURRENT_LLM_CALLS)
+
+        async def check(i: int) -> List[bool]:
+            async with sem:
+                return await check_incident_similarity_batch(new_texts[i], review[i])
+
+        results = dict(zip(review, await asyncio.gather(*(check(i) for i in review))))
+    for i, shortlist in shortlists.items():
+        matches[i] = best_confirmed(shortlist, results[i], all_priorities)
+
+    # Pass 3: resolve matches to stored solutions or earlier rows
+    solutions: List[Optional[str]] = []
+    reuse_from = {}  # row index -> earlier row index whose solution it shares
+    for i, match in enumerate(matches):
+        if match is not None and match < n_stored:
+            solutions.append(stored_solutions[match])
+            logging.info(f"Reused solution for Incident {inc_nos[i]}")
         else:
-            # Case 2: Try to reuse, otherwise generate
-            existing_solution = find_solution(desc, det_desc, existing_incidents)
-            if existing_solution:
-                solution = existing_solution
-                logging.info(f"Reused solution for Incident {inc_no}")
+            solutions.append(None)
+            if match is not None:
+                reuse_from[i] = match - n_stored
+                logging.info(f"Reused solution of an earlier row for Incident {inc_nos[i]}")
+
+    # Pass 4: generate the remaining solutions
+    to_generate = [i for i, sol in enumerate(solutions) if sol is None and i not in reuse_from]
+    if use_batch_api:
+        prompts = {i: solution_prompt(descs[i], det_descs[i]) for i in to_generate}
+        for i in to_generate:
+            solutions[i] = get_cached_solution(solution_cache_key(prompts[i]), new_embeddings[i])
+        pending = [i for i in to_generate if solutions[i] is None]
+        contents = await run_chat_batch({f"solution-{i}": solution_request(prompts[i]) for i in pending})
+        for i in pending:
+            content = contents.get(f"solution-{i}")
+            if content:  # None for missing results and for refusals
+                solutions[i] = content.strip()
+                cache_solution(solution_cache_key(prompts[i]), new_embeddings[i], solutions[i])
             else:
-                solution = generate_solution(desc, det_desc)
-                logging.info(f"Generated new solution for Incident {inc_no}")
+                solutions[i] = await generate_solution(descs[i], det_descs[i], new_embeddings[i])
+    else:
+        sem = asyncio.Semaphore(MAX_CONCURRENT_LLM_CALLS)
 
-        priority = calculate_priority(desc, det_desc)
+        async def generate(i: int) -> str:
+            async with sem:
+                return await generate_solution(descs[i], det_descs[i], new_embeddings[i])
 
-        new_records.append((
-            inc_no, cust, org, dept, desc, det_desc, rep_date, solution, priority
-        ))
+        generated = await asyncio.gather(*(generate(i) for i in to_generate))
+        for i, solution in zip(to_generate, generated):
+            solutions[i] = solution
+    for i in to_generate:
+        logging.info(f"Generated new solution for Incident {inc_nos[i]}")
+    for i, j in reuse_from.items():  # ascending, and j < i, so j is already resolved
+        solutions[i] = solutions[j]
 
-        # Keep memory in sync (but only if DB wasn’t empty initially)
-        if not db_empty:
-            existing_incidents.append((desc, det_desc, solution, priority))
+    blobs = [embedding_to_blob(embedding) for embedding in new_embeddings]
+    new_records = list(zip(
+        inc_nos, customers, orgs, depts, descs, det_descs, rep_dates, solutions, priorities, blobs
+    ))
 
-    # Batch insert all at once
+    # Batch insert all at once, in a single write transaction (one commit, one WAL sync)
+    cursor.execute("BEGIN IMMEDIATE")
     cursor.executemany("""
         INSERT INTO incidents
-        (Incident_Number, Customer_Name, Organization, Department, Description, Detailed_Description, Reported_Date, Solution, Priority)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        (Incident_Number, Customer_Name, Organization, Department, Description, Detailed_Description, Reported_Date, Solution, Priority, Embedding)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     """, new_records)
+    flush_solution_cache(conn)
 
     conn.commit()
     conn.close()
@@ -190,5 +758,5 @@ def process_excel(file_path: str):
 # ---- Runner ---- #
 if __name__ == "__main__":
     init_db()
-    process_excel("Incident Details with REQ and Reason Oct23-Mar24-App-Only (1).xlsx")
+    asyncio.run(process_excel("Incident Details with REQ and Reason Oct23-Mar24-App-Only (1).xlsx", use_batch_api=True))
     print("Incidents processed and pushed into DB successfully.")
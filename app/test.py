@@ -1,13 +1,43 @@
 import pytest
+import asyncio
+import json
 import sqlite3
 import os
+import threading
 import time
+import zlib
+import numpy as np
+from types import SimpleNamespace
+import main
+import functionality
 from main import (
-    init_db, calculate_priority, find_solution
+    init_db, calculate_priority, find_solution, check_incident_similarity_batch, EMBEDDING_DIM
 )
 
 DB_FILE = "incidents.db"
 
+
+def fake_embed_texts(texts):
+    """Deterministic bag-of-words embedding so tests never download the real model."""
+    vecs = np.zeros((len(texts), EMBEDDING_DIM), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in text.lower().split():
+            vecs[row, zlib.crc32(word.encode()) % EMBEDDING_DIM] += 1.0
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    return vecs / np.where(norms == 0, 1, norms)
+
+
+def as_columns(rows):
+    """find_solution arguments (texts, solutions, priorities, index) for fetched incident rows."""
+    texts, solutions, priorities = main.incident_columns(rows)
+    return texts, solutions, priorities, main.build_index(main.build_embedding_matrix(rows))
+
+
+def chat_client(create):
+    """Stand-in for main.get_client() whose chat completions call create."""
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
 # --- Pytest Fixtures --- #
 @pytest.fixture(autouse=True)
 def setup_and_teardown_db(monkeypatch):
@@ -15,10 +45,12 @@ def setup_and_teardown_db(monkeypatch):
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
     cursor.execute("DROP TABLE IF EXISTS incidents")
+    cursor.execute("DROP TABLE IF EXISTS solutions_cache")
     conn.commit()
     conn.close()
 
     init_db()
+    main.clear_solution_cache()
 
     # Insert 20 mock incidents (instead of populate_mock_data)
     conn = sqlite3.connect(DB_FILE)
@@ -45,19 +77,39 @@ def setup_and_teardown_db(monkeypatch):
     conn.commit()
     conn.close()
 
-    # Monkeypatch similarity check
-    monkeypatch.setattr("main.check_incident_similarity", lambda a, b: "Sample incident" in b and "Sample" in a)
+    # Monkeypatch similarity check and embedding model
+    async def fake_similarity(new_text, candidates):
+        return ["Sample incident" in c and "Sample" in new_text for c in candidates]
+
+    monkeypatch.setattr("main.check_incident_similarity_batch", fake_similarity)
+    monkeypatch.setattr("main.embed_texts", fake_embed_texts)
+    monkeypatch.setattr("main.estimate_tokens", lambda request: 100)
 
     yield
 
     # Cleanup
+    main.clear_solution_cache()
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
     cursor.execute("DROP TABLE IF EXISTS incidents")
+    cursor.execute("DROP TABLE IF EXISTS solutions_cache")
     conn.commit()
     conn.close()
 
 
+@pytest.fixture
+def llm_calls(monkeypatch):
+    """Candidate lists sent for LLM review; every candidate is answered NO."""
+    calls = []
+
+    async def counting_similarity(new_text, candidates):
+        calls.append(candidates)
+        return [False] * len(candidates)
+
+    monkeypatch.setattr("main.check_incident_similarity_batch", counting_similarity)
+    return calls
+
+
 # --- Core DB Tests --- #
 def test_db_created():
     conn = sqlite3.connect(DB_FILE)
@@ -75,10 +127,38 @@ def test_schema_columns():
     assert set(cols) == {
         "id", "Incident_Number", "Customer_Name", "Organization",
         "Department", "Description", "Detailed_Description",
-        "Reported_Date", "Solution", "Priority"
+        "Reported_Date", "Solution", "Priority", "Embedding"
     }
 
 
+def test_incident_load_scans_table_in_id_order():
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute("EXPLAIN QUERY PLAN " + main.INCIDENT_LOAD_QUERY)
+    plan = " ".join(row[-1] for row in cursor.fetchall())
+    assert "SCAN incidents" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def test_writer_retries_while_database_is_locked(monkeypatch):
+    monkeypatch.setattr(functionality, "WRITE_RETRY_DELAY", 0.05)
+    row = ("INC99", "Cust", "Org", "Dept", "desc", "det desc", "2024-02-01", "sol", 3, None)
+    blocker = sqlite3.connect(DB_FILE, isolation_level=None)
+    blocker.execute("BEGIN IMMEDIATE")
+    writer_conn = sqlite3.connect(DB_FILE, timeout=0, isolation_level=None, check_same_thread=False)
+
+    flush = threading.Thread(target=functionality._flush_writes, args=(writer_conn, [row]))
+    flush.start()
+    time.sleep(0.2)
+    blocker.rollback()
+    flush.join(timeout=5)
+
+    assert not flush.is_alive()
+    assert blocker.execute("SELECT count(*) FROM incidents WHERE Incident_Number = 'INC99'").fetchone()[0] == 1
+    writer_conn.close()
+    blocker.close()
+
+
 def test_id_autoincrements():
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
@@ -105,19 +185,205 @@ def test_priority_range():
 def test_find_solution_returns_str():
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
-    cursor.execute("SELECT Description, Detailed_Description, Solution, Priority FROM incidents")
+    cursor.execute(main.INCIDENT_LOAD_QUERY)
     existing_incidents = cursor.fetchall()
-    sol = find_solution("Sample incident 5 triggered issue", "Some details", existing_incidents)
+    sol = asyncio.run(find_solution("Sample incident 5 triggered issue", "Some details", *as_columns(existing_incidents)))
     assert isinstance(sol, str) or sol is None
 
 
 def test_find_solution_not_found():
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
-    cursor.execute("SELECT Description, Detailed_Description, Solution, Priority FROM incidents")
+    cursor.execute(main.INCIDENT_LOAD_QUERY)
+    existing_incidents = cursor.fetchall()
+    sol = asyncio.run(find_solution("Completely unknown issue", "Random details", *as_columns(existing_incidents)))
+    assert sol is None
+
+
+def test_find_solution_semantic_match_skips_llm(llm_calls):
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute(main.INCIDENT_LOAD_QUERY)
+    existing_incidents = cursor.fetchall()
+
+    sol = asyncio.run(find_solution("Sample incident 7", "Detailed description 7", *as_columns(existing_incidents)))
+    assert sol == "Apply standard resolution procedure 7"
+    assert llm_calls == []
+
+
+def test_find_solution_checks_only_shortlist(llm_calls):
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute(main.INCIDENT_LOAD_QUERY)
+    existing_incidents = cursor.fetchall()
+
+    asyncio.run(find_solution("Unrelated printer jam", "Paper stuck in tray", *as_columns(existing_incidents)))
+    assert len(llm_calls) == 1  # the whole shortlist goes out in one request
+    # at most TOP_K_CANDIDATES fuzzy hits plus TOP_K_CANDIDATES nearest embeddings
+    assert 0 < len(llm_calls[0]) <= 2 * main.TOP_K_CANDIDATES
+
+
+def test_find_solution_fuzzy_match_skips_llm(llm_calls):
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute(main.INCIDENT_LOAD_QUERY)
+    existing_incidents = cursor.fetchall()
+
+    sol = asyncio.run(find_solution("SAMPLE INCIDNET 7", "Detailed description 7.", *as_columns(existing_incidents)))
+    assert sol == "Apply standard resolution procedure 7"
+    assert llm_calls == []
+
+
+def test_find_solution_subset_fuzzy_match_goes_to_llm(llm_calls):
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute(main.INCIDENT_LOAD_QUERY)
     existing_incidents = cursor.fetchall()
-    sol = find_solution("Completely unknown issue", "Random details", existing_incidents)
+
+    # every stored text contains these words, so token_set_ratio alone scores 100
+    sol = asyncio.run(find_solution("Detailed description", "", *as_columns(existing_incidents)))
     assert sol is None
+    assert len(llm_calls) == 1
+
+
+def test_confirmed_match_prefers_highest_priority():
+    priorities = [2, 5, 3, 5]
+    assert main.best_confirmed([0, 2, 1, 3], [True, True, True, True], priorities) == 1
+    assert main.best_confirmed([0, 2, 1, 3], [True, True, False, False], priorities) == 2
+    assert main.best_confirmed([0, 2], [False, False], priorities) is None
+
+
+def test_similarity_batch_parses_single_response(monkeypatch):
+    requests = []
+
+    async def fake_create(**kwargs):
+        requests.append(kwargs)
+        message = SimpleNamespace(content='{"matches": ["NO", "yes", "NO"]}')
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    monkeypatch.setattr(main, "get_client", lambda: chat_client(fake_create))
+    result = asyncio.run(check_incident_similarity_batch("new", ["a", "b", "c"]))
+    assert result == [False, True, False]
+    assert len(requests) == 1
+
+
+def test_rate_limiter_waits_for_token_capacity():
+    limiter = main.RateLimiter(requests_per_minute=600, tokens_per_minute=60000)  # 1000 tokens/s
+
+    async def run():
+        await limiter.acquire(60000)
+        start = time.monotonic()
+        await limiter.acquire(100)
+        return time.monotonic() - start
+
+    assert asyncio.run(run()) >= 0.08
+
+
+def test_chat_completion_retries_only_transient_errors(monkeypatch):
+    attempts = []
+
+    async def failing_create(**kwargs):
+        attempts.append(kwargs)
+        raise ValueError("bad request")
+
+    monkeypatch.setattr(main, "get_client", lambda: chat_client(failing_create))
+    with pytest.raises(ValueError):
+        asyncio.run(main.chat_completion({"messages": []}))
+    assert len(attempts) == 1
+
+
+def test_run_chat_batch_maps_results_by_custom_id(monkeypatch):
+    uploaded = {}
+
+    async def fake_file_create(file, purpose):
+        uploaded["lines"] = [json.loads(line) for line in file[1].decode().splitlines()]
+        return SimpleNamespace(id="file-in")
+
+    async def fake_batch_create(**kwargs):
+        return SimpleNamespace(id="batch-1", status="in_progress", output_file_id=None)
+
+    async def fake_batch_retrieve(batch_id):
+        return SimpleNamespace(id=batch_id, status="completed", output_file_id="file-out")
+
+    async def fake_file_content(file_id):
+        out = [
+            {"custom_id": "b", "response": {"status_code": 200, "body": {"choices": [{"message": {"content": "second"}}]}}},
+            {"custom_id": "a", "response": {"status_code": 500, "body": {}}},
+            {"custom_id": "c", "response": {"status_code": 200, "body": {}}},
+        ]
+        return SimpleNamespace(text="\n".join([json.dumps(o) for o in out] + ["not json"]))
+
+    monkeypatch.setattr(main, "BATCH_POLL_INTERVAL", 0)
+    client = SimpleNamespace(
+        files=SimpleNamespace(create=fake_file_create, content=fake_file_content),
+        batches=SimpleNamespace(create=fake_batch_create, retrieve=fake_batch_retrieve),
+    )
+    monkeypatch.setattr(main, "get_client", lambda: client)
+
+    results = asyncio.run(main.run_chat_batch({"a": {"model": "m"}, "b": {"model": "m"}, "c": {"model": "m"}}))
+    assert results == {"b": "second"}  # failed, malformed and unreadable lines are skipped
+    assert [line["custom_id"] for line in uploaded["lines"]] == ["a", "b", "c"]
+    assert uploaded["lines"][0]["url"] == "/v1/chat/completions"
+
+
+def test_generate_solution_uses_cache(monkeypatch):
+    requests = []
+
+    async def fake_create(**kwargs):
+        requests.append(kwargs)
+        message = SimpleNamespace(content="Restart the print spooler")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    monkeypatch.setattr(main, "get_client", lambda: chat_client(fake_create))
+    first = asyncio.run(main.generate_solution("Printer offline", "Spooler stuck on floor 3"))
+    again = asyncio.run(main.generate_solution("Printer offline", "Spooler stuck on floor 3"))
+    assert first == again == "Restart the print spooler"
+    assert len(requests) == 1
+
+    # Persisted cache survives a restart and serves near-duplicates semantically
+    conn = main.connect_db()
+    assert main.flush_solution_cache(conn) == 1
+    conn.close()
+    main.clear_solution_cache()
+    near = asyncio.run(main.generate_solution("printer offline", "spooler stuck on floor 3"))
+    assert near == "Restart the print spooler"
+    assert len(requests) == 1
+
+
+def test_semantic_solution_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(main, "_solution_cache_loaded", True)
+    embeddings = fake_embed_texts([f"printer jam {i}" for i in range(main.SOLUTION_CACHE_SIZE + 5)])
+    for i, embedding in enumerate(embeddings):
+        main.cache_solution(f"key-{i}", embedding, f"solution {i}")
+    main._pending_cache_rows.clear()
+
+    assert main._semantic_count == main.SOLUTION_CACHE_SIZE
+    assert main.get_cached_solution("missing", embeddings[-1]) == f"solution {len(embeddings) - 1}"
+    assert "solution 0" not in main._semantic_solutions  # oldest entries were overwritten
+
+
+def test_embedding_blob_is_int8():
+    embedding = fake_embed_texts(["printer jam on floor 3"])[0]
+    blob = main.embedding_to_blob(embedding)
+    assert len(blob) == main.EMBEDDING_DIM
+    assert np.allclose(main.blob_to_embedding(blob), embedding, atol=0.5 / main.EMBEDDING_SCALE + 1e-6)
+    # float32 rows written before quantisation still decode
+    assert np.array_equal(main.blob_to_embedding(embedding.astype(np.float32).tobytes()), embedding)
+
+
+def test_vector_index_round_trip(tmp_path):
+    embeddings = fake_embed_texts(["printer jam", "vpn down", "disk full"])
+    path = str(tmp_path / "incidents.faiss")
+    checksum = main.texts_checksum(["printer jam", "vpn down", "disk full"])
+    main.save_index(main.build_index(embeddings), checksum, path)
+
+    index = main.load_index(3, checksum, path)
+    sims, ids = index.search(embeddings[1:2], 1)
+    assert ids[0][0] == 1
+    assert sims[0][0] == pytest.approx(1.0, abs=0.01)
+    assert main.load_index(4, checksum, path) is None  # out of step with the DB
+    # same row count, but the rows were replaced
+    assert main.load_index(3, main.texts_checksum(["vpn down", "disk full", "printer jam"]), path) is None
 
 
 def test_priority_calculation_keywords():
@@ -129,12 +395,31 @@ def test_priority_calculation_keywords():
     assert low == 2
 
 
+def test_priority_calculation_picks_highest_tier():
+    assert calculate_priority("Minor request", "then a crash") == 4
+    assert calculate_priority("Printer", "timeoutage on floor 3") == 5
+    assert calculate_priority("Printer", "toner low") == 1
+
+
+def test_priority_calculation_matches_substring_scan_on_long_text():
+    def substring_priority(description, detailed_description):  # the plain `in` scan
+        text = f"{description} {detailed_description}".lower()
+        for tier in sorted(main.PRIORITY_KEYWORDS, reverse=True):
+            if any(word in text for word in main.PRIORITY_KEYWORDS[tier]):
+                return tier
+        return 1
+
+    long_text = "The printer on the third floor keeps jamming the paper tray. " * 180  # ~11 KB
+    for detailed in (long_text, long_text + " then an error"):
+        assert calculate_priority("Printer", detailed) == substring_priority("Printer", detailed)
+
+
 def test_solution_text_contains_resolution():
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
-    cursor.execute("SELECT Description, Detailed_Description, Solution, Priority FROM incidents")
+    cursor.execute(main.INCIDENT_LOAD_QUERY)
     existing_incidents = cursor.fetchall()
-    sol = find_solution("Sample incident 10", "Details here", existing_incidents)
+    sol = asyncio.run(find_solution("Sample incident 10", "Details here", *as_columns(existing_incidents)))
     if sol:  # may be None if similarity fails
         assert "Apply standard resolution procedure" in sol
 
@@ -143,10 +428,10 @@ def test_solution_text_contains_resolution():
 def test_performance_on_20_incidents():
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
-    cursor.execute("SELECT Description, Detailed_Description, Solution, Priority FROM incidents")
+    cursor.execute(main.INCIDENT_LOAD_QUERY)
     existing_incidents = cursor.fetchall()
 
     start = time.time()
-    find_solution("Performance test issue", "details", existing_incidents)
+    asyncio.run(find_solution("Performance test issue", "details", *as_columns(existing_incidents)))
     elapsed = time.time() - start
     assert elapsed < 2